@@ -2,45 +2,35 @@ import streamlit as st
 import yfinance as yf
 import pandas as pd
 import numpy as np
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from numba import njit
+from datetime import datetime
 
+# Calendar days to the one month, three month and one year horizons
+HORIZON_DAYS = np.array([30, 90, 365])
 
-def get_stock_data(ticker, start_date, end_date):
-    stock = yf.Ticker(ticker)
-    data = stock.history(start=start_date, end=end_date)
-    data.index = pd.to_datetime(data.index).tz_localize(None)
-    return data
 
+class MissingPriceDataError(Exception):
+    def __init__(self, tickers):
+        super().__init__(f"No price data returned for {', '.join(tickers)}")
+        self.tickers = tickers
 
-def adjust_to_next_trading_day(data, date):
-    max_date = data.index.max()
-    while date.strftime("%Y-%m-%d") not in data.index:
-        date += timedelta(days=1)
-        if date > max_date:
-            return max_date
-    return date
 
+def get_stock_data(tickers, start_date, end_date):
+    data = yf.download(tickers, start=start_date, end=end_date, threads=5,
+                       group_by='ticker', auto_adjust=True, progress=False, timeout=15)
+    close = data.xs('Close', level=1, axis=1)
+    close.index = pd.to_datetime(close.index).tz_localize(None)
+    return close.reindex(columns=tickers)
 
-def get_stock_changes(ticker, start_date):
-    today = datetime.now()
-    data = get_stock_data(ticker, start_date, today)
-    start_date = adjust_to_next_trading_day(data, start_date)
 
-    def calculate_change(start_date, end_date):
-        end_date = adjust_to_next_trading_day(data, end_date)
-        start_price = data.loc[start_date.strftime("%Y-%m-%d")]["Close"]
-        end_price = data.loc[end_date.strftime("%Y-%m-%d")]["Close"]
-        return ((end_price - start_price) / start_price) * 100
+def get_stock_changes(closes, dates, start_date):
+    start_position = min(np.searchsorted(dates, np.datetime64(start_date, 'D')), len(dates) - 1)
+    targets = dates[start_position] + HORIZON_DAYS
+    end_positions = np.minimum(np.searchsorted(dates, targets), len(dates) - 1)
 
-    one_month_change = calculate_change(start_date, start_date + timedelta(days=30))
-    three_month_change = calculate_change(start_date, start_date + timedelta(days=90))
-
-    max_end_date = data.index.max()
-    end_date_one_year = start_date + timedelta(days=365)
-    if end_date_one_year > max_end_date:
-        one_year_change = calculate_change(start_date, max_end_date)
-    else:
-        one_year_change = calculate_change(start_date, end_date_one_year)
+    start_price = closes[start_position]
+    one_month_change, three_month_change, one_year_change = (closes[end_positions] - start_price) / start_price * 100
 
     cagr = ((1 + one_year_change / 100) ** (1 / 1) - 1) * 100
 
@@ -52,49 +42,141 @@ def get_stock_changes(ticker, start_date):
     }
 
 
-def calculate_portfolio_volatility(pairs, start_date):
-    today = datetime.now()
-    combined_returns = []
+def get_pair_returns(close, pairs):
+    # Returns across a ticker's own gaps, like a per-ticker dropna().pct_change()
+    returns = close.ffill().pct_change(fill_method=None).where(close.notna()).dropna(how='all')
+    long_returns = returns[[long_ticker for long_ticker, _ in pairs]].to_numpy()
+    short_returns = returns[[short_ticker for _, short_ticker in pairs]].to_numpy()
+    return pd.DataFrame(long_returns - short_returns, index=returns.index)
 
-    for long_ticker, short_ticker in pairs:
-        long_data = get_stock_data(long_ticker, start_date, today)
-        short_data = get_stock_data(short_ticker, start_date, today)
 
-        long_returns = long_data['Close'].pct_change().dropna()
-        short_returns = short_data['Close'].pct_change().dropna()
+def get_portfolio_returns(pair_returns):
+    return pair_returns.dropna().mean(axis=1)
 
-        pair_returns = long_returns - short_returns
-        combined_returns.append(pair_returns)
 
-    combined_returns_df = pd.concat(combined_returns, axis=1).dropna()
-    portfolio_returns = combined_returns_df.mean(axis=1)
+@njit(cache=True, error_model='numpy')
+def calculate_pair_metrics(pair_returns, risk_free_rate):
+    count = 0
+    mean_return = 0.0
+    sum_squares = 0.0
+    cumulative_return = 1.0
+    peak = -np.inf
+    max_drawdown = 0.0
 
-    portfolio_volatility = portfolio_returns.std() * np.sqrt(252) * 100
-    return portfolio_volatility, portfolio_returns
+    for pair_return in pair_returns:
+        if np.isnan(pair_return):
+            continue
 
+        # Welford's running mean and variance
+        count += 1
+        delta = pair_return - mean_return
+        mean_return += delta / count
+        sum_squares += delta * (pair_return - mean_return)
 
-def calculate_max_drawdown(returns):
-    cumulative_returns = (1 + returns).cumprod()
-    peak = cumulative_returns.cummax()
-    drawdown = (cumulative_returns - peak) / peak
-    max_drawdown = drawdown.min() * 100
-    return max_drawdown
+        cumulative_return *= 1 + pair_return
+        peak = max(peak, cumulative_return)
+        max_drawdown = min(max_drawdown, cumulative_return / peak - 1)
 
+    # Too few returns for a sample variance, and no drawdown without any
+    if count < 2:
+        return np.nan, np.nan, np.nan
 
-def calculate_sharpe_ratio(returns, risk_free_rate):
-    mean_return = returns.mean() * 252
-    volatility = returns.std() * np.sqrt(252)
-    sharpe_ratio = (mean_return - risk_free_rate) / volatility
-    return sharpe_ratio
+    volatility = np.sqrt(sum_squares / (count - 1)) * np.sqrt(252)
+    sharpe_ratio = (mean_return * 252 - risk_free_rate) / volatility
+    return volatility * 100, max_drawdown * 100, sharpe_ratio
 
 
 def get_risk_free_rate(start_date):
-    treasury_data = yf.Ticker("^TNX").history(start=start_date)
-    treasury_data = treasury_data.resample('D').ffill().dropna()
-    average_yield = treasury_data['Close'].mean() / 100
+    treasury_data = yf.Ticker("^TNX").history(start=start_date, timeout=15)
+    if treasury_data.empty:
+        return np.nan
+    # Weight each close by the calendar days it stays in effect, same as a daily forward fill
+    dates = treasury_data.index.tz_localize(None).normalize().values
+    weights = np.append(np.diff(dates).astype('timedelta64[D]').astype(int), 1)
+    average_yield = np.average(treasury_data['Close'].to_numpy(), weights=weights) / 100
     return average_yield
 
 
+@st.cache_data(ttl=3600, show_spinner=False)
+def compute_all_metrics(pairs, start_date):
+    adjusted_start_date = datetime.fromisoformat(start_date)
+
+    tickers = sorted({ticker for pair in pairs for ticker in pair})
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        risk_free_future = executor.submit(get_risk_free_rate, adjusted_start_date)
+        close_future = executor.submit(get_stock_data, tickers, adjusted_start_date, datetime.now())
+    risk_free_rate = risk_free_future.result()
+    close = close_future.result()
+
+    # Raise rather than return, so st.cache_data never stores a failed download
+    missing_tickers = [ticker for ticker in tickers if close[ticker].dropna().empty]
+    if missing_tickers:
+        raise MissingPriceDataError(missing_tickers)
+
+    stock_changes = {}
+    for ticker in tickers:
+        prices = close[ticker].dropna()
+        stock_changes[ticker] = get_stock_changes(prices.to_numpy(), prices.index.values.astype('datetime64[D]'),
+                                                  adjusted_start_date)
+
+    pair_returns = get_pair_returns(close, pairs)
+    pair_returns_matrix = pair_returns.to_numpy()
+
+    results = []
+    total_returns = {"One Month": 0, "Three Months": 0, "One Year": 0, "CAGR": 0}
+    num_pairs = len(pairs)
+
+    for i, (long_ticker, short_ticker) in enumerate(pairs):
+        long_results = stock_changes[long_ticker]
+        short_results = stock_changes[short_ticker]
+
+        difference = {
+            period: long_results[period] - short_results[period]
+            for period in long_results
+        }
+
+        pair_volatility, pair_max_drawdown, pair_sharpe_ratio = calculate_pair_metrics(
+            pair_returns_matrix[:, i], risk_free_rate)
+
+        results.append({
+            "Long Ticker": long_ticker,
+            "Short Ticker": short_ticker,
+            "Difference (One Month)": difference["One Month"],
+            "Difference (Three Months)": difference["Three Months"],
+            "Difference (One Year)": difference["One Year"],
+            "Difference (CAGR)": difference["CAGR"],
+            "Pair Volatility": pair_volatility,
+            "Max Drawdown": pair_max_drawdown,
+            "Sharpe Ratio": pair_sharpe_ratio
+        })
+
+        # Aggregate total returns
+        for period in total_returns:
+            total_returns[period] += difference[period] / num_pairs
+
+    # Calculate total portfolio volatility and returns
+    total_portfolio_returns = get_portfolio_returns(pair_returns)
+    total_volatility, total_max_drawdown, total_sharpe_ratio = calculate_pair_metrics(
+        total_portfolio_returns.to_numpy(), risk_free_rate)
+
+    # Append total portfolio results
+    results.append({
+        "Long Ticker": "Total Portfolio",
+        "Short Ticker": "",
+        "Difference (One Month)": total_returns["One Month"],
+        "Difference (Three Months)": total_returns["Three Months"],
+        "Difference (One Year)": total_returns["One Year"],
+        "Difference (CAGR)": total_returns["CAGR"],
+        "Pair Volatility": total_volatility,
+        "Max Drawdown": total_max_drawdown,
+        "Sharpe Ratio": total_sharpe_ratio
+    })
+
+    # Convert results to DataFrame
+    results_df = pd.DataFrame(results)
+    return results_df, risk_free_rate
+
+
 def main():
     st.title("Stock Pair Returns")
 
@@ -118,90 +200,41 @@ def main():
 
     if submit_button:
         start_date = start_date.strftime("%Y-%m-%d")
-        adjusted_start_date = datetime.strptime(start_date, "%Y-%m-%d")
 
-        risk_free_rate = get_risk_free_rate(adjusted_start_date)
+        # yf.download upper-cases tickers in its columns; pairs with a blank field are left out
+        pairs = [(long_ticker.strip().upper(), short_ticker.strip().upper()) for long_ticker, short_ticker in pairs]
+        pairs = [pair for pair in pairs if pair[0] and pair[1]]
+        if not pairs:
+            st.warning("Enter a long and a short ticker for at least one pair")
+            return
+
+        # Each retry drops the tickers Yahoo returned no prices for
+        while True:
+            try:
+                results_df, risk_free_rate = compute_all_metrics(tuple(pairs), start_date)
+                break
+            except MissingPriceDataError as error:
+                st.warning(f"{error}; skipped the pairs using them")
+                pairs = [pair for pair in pairs if pair[0] not in error.tickers and pair[1] not in error.tickers]
+                if not pairs:
+                    return
         st.session_state.risk_free_rate = risk_free_rate
 
-        results = []
-        total_returns = {"One Month": 0, "Three Months": 0, "One Year": 0, "CAGR": 0}
-        all_combined_returns = []
-
-        for long_ticker, short_ticker in pairs:
-            long_results = get_stock_changes(long_ticker, adjusted_start_date)
-            short_results = get_stock_changes(short_ticker, adjusted_start_date)
-
-            difference = {
-                period: long_results[period] - short_results[period]
-                for period in long_results
-            }
-
-            formatted_difference = {
-                period: f"{difference[period]:.2f}%" for period in difference
-            }
-
-            pair_volatility, pair_returns = calculate_portfolio_volatility([(long_ticker, short_ticker)],
-                                                                           adjusted_start_date)
-            pair_max_drawdown = calculate_max_drawdown(pair_returns)
-            pair_sharpe_ratio = calculate_sharpe_ratio(pair_returns, risk_free_rate)
-
-            all_combined_returns.append(pair_returns)
-
-            results.append({
-                "Long Ticker": long_ticker,
-                "Short Ticker": short_ticker,
-                "Difference (One Month)": formatted_difference["One Month"],
-                "Difference (Three Months)": formatted_difference["Three Months"],
-                "Difference (One Year)": formatted_difference["One Year"],
-                "Difference (CAGR)": formatted_difference["CAGR"],
-                "Pair Volatility": f"{pair_volatility:.2f}%",
-                "Max Drawdown": f"{pair_max_drawdown:.2f}%",
-                "Sharpe Ratio": f"{pair_sharpe_ratio:.2f}"
-            })
-
-            # Aggregate total returns
-            num_pairs = len(pairs)
-            for period in total_returns:
-                total_returns[period] += difference[period] / num_pairs
-
-        # Calculate total portfolio volatility and returns
-        total_volatility, total_portfolio_returns = calculate_portfolio_volatility(pairs, adjusted_start_date)
-        total_max_drawdown = calculate_max_drawdown(total_portfolio_returns)
-        total_sharpe_ratio = calculate_sharpe_ratio(total_portfolio_returns, risk_free_rate)
-
-        # Convert results to DataFrame
-        results_df = pd.DataFrame(results)
-
-        # Calculate total portfolio returns
-        total_returns_formatted = {period: f"{total_returns[period]:.2f}%" for period in total_returns}
-        total_volatility_formatted = f"{total_volatility:.2f}%"
-        total_max_drawdown_formatted = f"{total_max_drawdown:.2f}%"
-        total_sharpe_ratio_formatted = f"{total_sharpe_ratio:.2f}"
-
-        # Append total portfolio results
-        total_row = pd.Series({
-            "Long Ticker": "Total Portfolio",
-            "Short Ticker": "",
-            "Difference (One Month)": total_returns_formatted["One Month"],
-            "Difference (Three Months)": total_returns_formatted["Three Months"],
-            "Difference (One Year)": total_returns_formatted["One Year"],
-            "Difference (CAGR)": total_returns_formatted["CAGR"],
-            "Pair Volatility": total_volatility_formatted,
-            "Max Drawdown": total_max_drawdown_formatted,
-            "Sharpe Ratio": total_sharpe_ratio_formatted
-        })
-
-        results_df = pd.concat([results_df, total_row.to_frame().T], ignore_index=True)
-
-        # Convert DataFrame to HTML
-        results_html = results_df.to_html(index=False)
+        formatters = {
+            "Difference (One Month)": "{:.2f}%".format,
+            "Difference (Three Months)": "{:.2f}%".format,
+            "Difference (One Year)": "{:.2f}%".format,
+            "Difference (CAGR)": "{:.2f}%".format,
+            "Pair Volatility": "{:.2f}%".format,
+            "Max Drawdown": "{:.2f}%".format,
+            "Sharpe Ratio": "{:.2f}".format
+        }
 
-        # Save HTML to file
-        with open("stock_returns.html", "w") as file:
-            file.write(results_html)
+        # Save results to HTML file
+        results_df.to_html("stock_returns.html", index=False, formatters=formatters)
 
         st.success("Results saved to stock_returns.html")
-        st.write(results_df)
+        st.write(results_df.style.format(formatters))
 
         # Advanced details to show calculated risk-free rate
         with st.expander("Advanced Details"):